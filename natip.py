@@ -1,299 +1,1125 @@
 #!/usr/bin/env python3
 
-import argparse
-
-from ipaddress import IPv4Address
-from pathlib import Path
-from random import choice
-from shutil import which
+# Heavier modules (asyncio, concurrent.futures, http.client, json, ...)
+# are imported by the code paths that need them, so --list and cached
+# runs do not pay for them at start-up.
+from os import environ, getpid, makedirs, replace, unlink, urandom
+from os.path import dirname, expanduser, join
+from random import Random
+from re import compile as re_compile, DOTALL
 from signal import signal, SIGPIPE, SIG_DFL
-from subprocess import run
-from sys import argv
-from urllib.parse import urlparse
-from urllib.request import urlopen
+from socket import socket, create_connection, getaddrinfo, inet_ntoa
+from socket import AF_INET, SOCK_DGRAM
+from struct import pack, unpack
+from sys import argv, exit, modules, version_info
+from threading import Lock, Thread
+from time import time
+from types import SimpleNamespace
+
+
+class _Log:
+    # Stands in for getLogger('natip') without importing logging. Until
+    # something imports it nobody can have set up a handler, so the
+    # records would be dropped anyway.
+    __slots__ = ()
+
+    @staticmethod
+    def _drop(*args, **kwargs):
+        pass
+
+    def __getattr__(self, attr):
+        if 'logging' not in modules:
+            return self._drop
+        from logging import getLogger
+        return getattr(getLogger('natip'), attr)
+
+
+# Verbose output, main() sends it to stderr with a '# ' prefix
+log = _Log()
+_LOG_HANDLER = None
+# Same agent urlopen() sends, some resolvers tailor the reply to it
+USER_AGENT = f"Python-urllib/{version_info[0]}.{version_info[1]}"
+
+_SSL_CTX = None
+
+
+# One context for every HTTPS resolver, so the CA bundle is loaded once
+# rather than for each new connection.
+def _ssl_context():
+    global _SSL_CTX
+    if _SSL_CTX is None:
+        from ssl import create_default_context
+        _SSL_CTX = create_default_context()
+    return _SSL_CTX
 
-VERBOSE = 0
 
 class NATAddressWWW:
+    __slots__ = ('url', 'timeout', '_conn', '_lock', '_session', '_hop')
+    REDIRECTS = (301, 302, 303, 307, 308)
+
     def __init__(self, url, timeout=5):
         self.url = url
         self.timeout = timeout
+        self._conn = None
+        self._lock = Lock()
+        self._session = None  # Last TLS session, resumed on reconnect
+        self._hop = None  # Redirect target, kept for its connection
 
-    def get(self):
-        if VERBOSE > 1:
-            print(f"# www: {self.url}")
+    def _proxy(self, o):
+        # Honour http_proxy/https_proxy/no_proxy the way urlopen() does
+        from urllib.parse import urlparse
+        from urllib.request import getproxies, proxy_bypass
+        proxy = getproxies().get(o.scheme)
+        if not proxy or proxy_bypass(o.hostname):
+            return None
+        if '://' not in proxy:
+            proxy = f"http://{proxy}"
+        return urlparse(proxy)
+
+    @staticmethod
+    def _proxy_headers(proxy):
+        if proxy.username is None:
+            return {}
+        from base64 import b64encode
+        from urllib.parse import unquote
+        cred = f"{unquote(proxy.username)}:{unquote(proxy.password or '')}"
+        return { 'Proxy-Authorization':
+                 f"Basic {b64encode(cred.encode()).decode('ascii')}" }
+
+    def _connect(self):
+        from http.client import HTTPConnection, HTTPSConnection
+        from urllib.parse import urlparse
+        o = urlparse(self.url)
+        path = o.path or '/'
+        headers = { 'User-Agent': USER_AGENT }
+        proxy = self._proxy(o)
+        if o.scheme != 'https':
+            if proxy is None:
+                conn = HTTPConnection(o.hostname, o.port,
+                                      timeout=self.timeout)
+                return conn, path, headers
+            # Plain HTTP goes through the proxy with an absolute URL
+            conn = HTTPConnection(proxy.hostname, proxy.port,
+                                  timeout=self.timeout)
+            headers.update(self._proxy_headers(proxy))
+            return conn, f"http://{o.netloc}{path}", headers
+        ctx = _ssl_context()
+        if proxy is not None:
+            conn = HTTPSConnection(proxy.hostname, proxy.port,
+                                   timeout=self.timeout, context=ctx)
+            conn.set_tunnel(o.hostname, o.port or 443,
+                            headers=self._proxy_headers(proxy))
+            return conn, path, headers
+        conn = HTTPSConnection(o.hostname, o.port, timeout=self.timeout,
+                               context=ctx)
+        if self._session is not None:
+            # http.client cannot pass a session to wrap_socket(), hand it
+            # an already connected socket resuming the last one instead.
+            sock = create_connection((o.hostname, o.port or 443),
+                                     self.timeout)
+            try:
+                conn.sock = ctx.wrap_socket(
+                    sock, server_hostname=o.hostname, session=self._session)
+            except Exception:
+                sock.close()
+                raise
+        return conn, path, headers
+
+    def _request(self):
+        if self._conn is None:
+            self._conn = self._connect()
+        conn, path, headers = self._conn
+        conn.request('GET', path, headers=headers)
+        sock = conn.sock
+        rsp = conn.getresponse()
+        if hasattr(sock, 'session'):
+            # TLS 1.3 tickets arrive after the handshake, save it while
+            # the response still holds the socket open.
+            self._session = sock.session
+        return rsp, rsp.read()
+
+    def _redirect(self, location):
+        # Follow a single hop, like urlopen() would for http -> https.
+        # The target gets its own resolver (and connection), kept while
+        # the server keeps pointing at it.
+        from urllib.parse import urljoin, urlparse
+        url = urljoin(self.url, location)
+        if urlparse(url).scheme not in ('http', 'https'):
+            raise ValueError(f"redirect to '{url}'")
+        if self._hop is None or self._hop.url != url:
+            if self._hop is not None:
+                self._hop.close()
+            self._hop = NATAddressWWW(url=url, timeout=self.timeout)
+        log.debug('www: %s redirects to %s', self.url, url)
+        return self._hop
+
+    def get(self, redirect=True):
+        log.debug('www: %s', self.url)
+        # Keep the connection open between calls so repeated lookups of
+        # the same resolver reuse the TCP (and TLS) session.
+        with self._lock:
+            while True:
+                reused = self._conn is not None
+                try:
+                    rsp, body = self._request()
+                except (BrokenPipeError, ConnectionResetError) as e:
+                    self._close_conn()
+                    if reused:
+                        continue  # Idle connection dropped, retry once
+                    self._session = None
+                    return False, f"{e} url='{self.url}'"
+                except Exception as e:
+                    self._session = None
+                    self._close_conn()
+                    return False, f"{e} url='{self.url}'"
+                break
+            if rsp.will_close:
+                self._close_conn()
+            hop = None
+            location = rsp.getheader('Location')
+            if redirect and rsp.status in self.REDIRECTS and location:
+                try:
+                    hop = self._redirect(location)
+                except ValueError as e:
+                    return False, f"{e} url='{self.url}'"
+        if hop is not None:
+            return hop.get(redirect=False)
+        if rsp.status != 200:
+            return False, f"status {rsp.status} url='{self.url}'"
         try:
-            rsp = urlopen(url=self.url, timeout=self.timeout)
+            ip = body.decode('ascii').strip()
         except Exception as e:
             return False, f"{e} url='{self.url}'"
-        if rsp.status != 200:
-            return False, "status {rsp.status} url='{self.url}'"
+        return True, ip
+
+    async def _fetch(self):
+        import asyncio
+        from urllib.parse import urlparse
+        o = urlparse(self.url)
+        https = o.scheme == 'https'
+        # HTTP/1.0 keeps the reply unchunked and closed by the server
+        req = (f"GET {o.path or '/'} HTTP/1.0\r\nHost: {o.netloc}\r\n"
+               f"User-Agent: {USER_AGENT}\r\n\r\n")
+        reader, writer = await asyncio.open_connection(
+            o.hostname, o.port or (443 if https else 80),
+            ssl=_ssl_context() if https else None)
+        try:
+            writer.write(req.encode('ascii'))
+            return await reader.read()
+        finally:
+            writer.close()
+
+    async def get_async(self, redirect=True):
+        import asyncio
+        from urllib.parse import urlparse
+        log.debug('www async: %s', self.url)
+        if self._proxy(urlparse(self.url)) is not None:
+            # asyncio streams have no proxy support, let the blocking
+            # path (which honours it) run in a daemon thread instead. Not
+            # asyncio.to_thread(), asyncio.run() would wait for it.
+            loop = asyncio.get_running_loop()
+            fut = loop.create_future()
+
+            def done(result):
+                if not fut.done():
+                    fut.set_result(result)
+
+            def probe():
+                result = self.get()
+                try:
+                    loop.call_soon_threadsafe(done, result)
+                except RuntimeError:
+                    pass  # Loop already closed, the race is over
+
+            Thread(target=probe, daemon=True).start()
+            return await fut
+        try:
+            data = await asyncio.wait_for(self._fetch(), self.timeout)
+        except Exception as e:
+            return False, f"{e!r} url='{self.url}'"
+        head, _, body = data.partition(b'\r\n\r\n')
         try:
-            ip = rsp.read().decode('ascii').strip()
+            status = int(head.split(None, 2)[1])
+            ip = body.decode('ascii').strip()
         except Exception as e:
             return False, f"{e} url='{self.url}'"
+        if redirect and status in self.REDIRECTS:
+            for line in head.split(b'\r\n')[1:]:
+                key, _, val = line.partition(b':')
+                if key.strip().lower() == b'location':
+                    try:
+                        hop = self._redirect(val.strip().decode('ascii'))
+                    except ValueError as e:
+                        return False, f"{e} url='{self.url}'"
+                    return await hop.get_async(redirect=False)
+        if status != 200:
+            return False, f"status {status} url='{self.url}'"
         return True, ip
 
+    def _close_conn(self):
+        if self._conn is not None:
+            self._conn[0].close()
+            self._conn = None
+
+    def close(self):
+        self._close_conn()
+        if self._hop is not None:
+            self._hop.close()
+
+
+# Server hostname -> (IPv4 addresses, expiry time). Looking up a DNS
+# nameserver or STUN server is itself a DNS lookup, only pay for it once
+# an hour.
+_HOST_CACHE = {}
+_HOST_TTL = 3600
+
+
+def _resolve_host(host):
+    ips, expiry = _HOST_CACHE.get(host, ((), 0))
+    if expiry < time():
+        ips = tuple({ ai[4][0] for ai in getaddrinfo(
+            host, None, family=AF_INET, type=SOCK_DGRAM) })
+        _HOST_CACHE[host] = (ips, time() + _HOST_TTL)
+    return ips
+
 
 class NATAddressDNS:
-    def __init__(self, dig_bin, servers, dns_name,
-                 dns_class='', dns_type='', timeout=5):
-        self.dig_bin = dig_bin
+    __slots__ = ('servers', 'dns_name', 'dns_class', 'dns_type', 'timeout',
+                 '_qtype', '_query', '_rng')
+    CLASSES = { 'in': 1, 'ch': 3 }
+    TYPES = { 'a': 1, 'txt': 16 }
+    _IP_RE = re_compile(rb'\d+\.\d+\.\d+\.\d+')
+
+    def __init__(self, servers, dns_name, dns_class='', dns_type='',
+                 timeout=5):
         self.servers = servers
         self.dns_name = dns_name
         self.dns_class = dns_class
         self.dns_type = dns_type
         self.timeout = timeout
+        # Own generator (seeded from os.urandom) rather than the shared
+        # module one, so racing threads do not share its state.
+        self._rng = Random()
+        try:
+            qclass = self.CLASSES[(dns_class or 'in').lower()]
+            self._qtype = self.TYPES[(dns_type or 'a').lower()]
+        except KeyError as e:
+            raise ValueError(f"unsupported DNS class/type {e}") from None
+        # The query never changes apart from its 2 byte id, build the rest
+        # once. Header: flags (RD), 1 question, 0 answer/authority/additional
+        q = pack('>HHHHH', 0x0100, 1, 0, 0, 0)
+        for label in dns_name.rstrip('.').split('.'):
+            label = label.encode('ascii')
+            q += bytes([len(label)]) + label
+        self._query = q + pack('>BHH', 0, self._qtype, qclass)
+
+    @staticmethod
+    def _skip_name(data, off):
+        while True:
+            n = data[off]
+            if n & 0xc0 == 0xc0:  # compression pointer ends the name
+                return off + 2
+            off += n + 1
+            if n == 0:
+                return off
+
+    def _parse(self, data):
+        flags, qdcount, ancount = unpack('>HHH', data[2:8])
+        if flags & 0x000f:
+            raise ValueError(f"rcode {flags & 0x000f}")
+        off = 12
+        for _ in range(qdcount):
+            off = self._skip_name(data, off) + 4
+        for _ in range(ancount):
+            off = self._skip_name(data, off)
+            rtype, _, _, rdlen = unpack('>HHIH', data[off:off + 10])
+            off += 10
+            rdata = data[off:off + rdlen]
+            off += rdlen
+            if rtype != self._qtype:
+                continue  # CNAME and friends
+            if rtype == 1:
+                return inet_ntoa(rdata)
+            # TXT: one or more length-prefixed strings, scan each for the
+            # IP without decoding or splitting. Some services prefix it
+            # with a label, e.g. "ns" "192.0.2.1".
+            i = 0
+            while i < len(rdata):
+                m = self._IP_RE.search(rdata, i + 1, i + 1 + rdata[i])
+                if m:
+                    return m.group().decode('ascii')
+                i += 1 + rdata[i]
+        raise ValueError("no answer")
 
     def get(self):
-        cmd = [ self.dig_bin, f"@{choice(self.servers)}" ]
-        if self.dns_class:
-            cmd += [ '-c', self.dns_class ]
-        if self.dns_type:
-            cmd += [ '-t', self.dns_type ]
-        cmd += [ '-q', self.dns_name, "+short", f"+time={self.timeout}" ]
-
-        if VERBOSE > 1:
-            print(f"# DNS: {' '.join(cmd)}")
+        server = self._rng.choice(self.servers)
+        log.debug('DNS: @%s %s %s %s', server, self.dns_name,
+                  self.dns_class or 'in', self.dns_type or 'a')
+        txid = urandom(2)
         try:
-            cp = run(cmd, check=True, universal_newlines=True,
-                     capture_output=True)
+            with socket(AF_INET, SOCK_DGRAM) as sock:
+                sock.settimeout(self.timeout)
+                sock.connect((self._rng.choice(_resolve_host(server)), 53))
+                sock.send(txid + self._query)
+                while True:
+                    data = sock.recv(4096)
+                    if data[:2] == txid:
+                        break
         except Exception as e:
-            return False, f"DNS exception {e} cmd={cmd}"
-        # Remove '"' characters and any prefix words. The currently supported
-        # services alaways place the returned IP last separated by spaces
-        # on the first line (when using +short with dig).
+            return False, f"DNS exception {e} server='{server}'"
         try:
-            ip = cp.stdout.split('\n')[0].replace('"', '').split()[-1]
+            ip = self._parse(data)
         except Exception as e:
-            return False, f"DNS dig response {e} cmd={cmd}"
+            return False, f"DNS response {e} server='{server}'"
         return True, ip
 
 
+# As strict as IPv4Address(), exactly four decimal octets without signs,
+# spaces or leading zeros, but without building an object per lookup.
+# Returns the address as an int or None when s is not valid.
+def _parse_ipv4(s):
+    try:
+        parts = s.encode('ascii').split(b'.')
+    except (AttributeError, UnicodeError):
+        return None
+    if len(parts) != 4:
+        return None
+    v = 0
+    for c in parts:
+        if not c.isdigit() or len(c) > 3 or (len(c) > 1 and c[0] == 0x30):
+            return None
+        n = int(c)
+        if n > 255:
+            return None
+        v = v << 8 | n
+    return v
+
+
+STUN_MAGIC_COOKIE = b'\x21\x12\xa4\x42'
+
+
+def _stun_request(txid):
+    # RFC 5389 Binding Request: type, length (no attributes), cookie, id
+    return b'\x00\x01\x00\x00' + STUN_MAGIC_COOKIE + txid
+
+
+def _stun_parse(data, txid):
+    if len(data) < 20 or data[:2] != b'\x01\x01':
+        raise ValueError("not a STUN binding response")
+    if data[8:20] != txid:
+        raise ValueError("STUN transaction id mismatch")
+    mapped = None
+    off, end = 20, min(len(data), 20 + unpack('>H', data[2:4])[0])
+    while off + 4 <= end:
+        atype, alen = unpack('>HH', data[off:off + 4])
+        val = data[off + 4:off + 4 + alen]
+        off += 4 + (alen + 3) // 4 * 4  # attributes are 32-bit aligned
+        if alen < 8 or val[1] != 0x01:  # IPv4 family only
+            continue
+        if atype in (0x0020, 0x8020):  # XOR-MAPPED-ADDRESS
+            return inet_ntoa(bytes(a ^ b for a, b in
+                                   zip(val[4:8], STUN_MAGIC_COOKIE)))
+        if atype == 0x0001:  # MAPPED-ADDRESS, RFC 3489 servers
+            mapped = inet_ntoa(val[4:8])
+    if mapped is None:
+        raise ValueError("no mapped address in STUN response")
+    return mapped
+
+
+def _stun_query(server, timeout, rng):
+    host, _, port = server.partition(':')
+    txid = urandom(12)
+    with socket(AF_INET, SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect((rng.choice(_resolve_host(host)), int(port or 3478)))
+        sock.send(_stun_request(txid))
+        while True:
+            data = sock.recv(1500)
+            if data[8:20] == txid:
+                return _stun_parse(data, txid)
+
+
 class NATAddressSTUN:
-    def __init__(self, stunip_bin, server, timeout=5):
-        self.stunip_bin = stunip_bin
+    __slots__ = ('server', 'timeout', '_rng')
+
+    def __init__(self, server, timeout=5):
         self.server = server
         self.timeout = timeout
+        self._rng = Random()
 
     def get(self):
-        cmd = [ self.stunip_bin, '-t', '1', '-m', str(self.timeout),
-                self.server ]
-        if VERBOSE > 1:
-            print(f"# STUN: {' '.join(cmd)}")
+        log.debug('STUN: %s', self.server)
         try:
-            cp = run(cmd, check=True, universal_newlines=True,
-                     capture_output=True)
+            ip = _stun_query(self.server, self.timeout, self._rng)
         except Exception as e:
-            return False, f"STUN exception {e} cmd={cmd}"
+            return False, f"STUN exception {e} server='{self.server}'"
+        return True, ip
+
+
+class NATAddressUPnP:
+    __slots__ = ('timeout',)
+    SERVICES = ('urn:schemas-upnp-org:service:WANIPConnection:1',
+                'urn:schemas-upnp-org:service:WANIPConnection:2',
+                'urn:schemas-upnp-org:service:WANPPPConnection:1')
+    _SERVICE_RE = re_compile(rb'<service>(.*?)</service>', DOTALL)
+    _TYPE_RE = re_compile(rb'<serviceType>\s*(.*?)\s*</serviceType>')
+    _CONTROL_RE = re_compile(rb'<controlURL>\s*(.*?)\s*</controlURL>')
+    SSDP_WAIT = 1  # Seconds, gateways answer within MX (1) seconds
+    _IP_RE = re_compile(rb'<NewExternalIPAddress>\s*(\d+\.\d+\.\d+\.\d+)'
+                        rb'\s*</NewExternalIPAddress>')
+
+    def __init__(self, timeout=5):
+        self.timeout = timeout
+
+    def _discover(self, timeout):
+        # SSDP search for the gateway, returns its description LOCATION.
+        # Other devices may answer too, so the wait for the gateway is
+        # bounded by one deadline rather than per datagram.
+        deadline = time() + min(timeout, self.SSDP_WAIT)
+        with socket(AF_INET, SOCK_DGRAM) as sock:
+            for st in self.SERVICES:
+                sock.sendto(('M-SEARCH * HTTP/1.1\r\n'
+                             'HOST: 239.255.255.250:1900\r\n'
+                             'MAN: "ssdp:discover"\r\n'
+                             'MX: 1\r\n'
+                             f'ST: {st}\r\n\r\n').encode('ascii'),
+                            ('239.255.255.250', 1900))
+            while True:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    raise TimeoutError("no SSDP reply from a gateway")
+                sock.settimeout(remaining)
+                data, (addr, _) = sock.recvfrom(2048)
+                for line in data.split(b'\r\n'):
+                    key, _, val = line.partition(b':')
+                    if key.strip().lower() != b'location':
+                        continue
+                    location = val.strip().decode('ascii', 'replace')
+                    # Only trust a description served by the replying
+                    # device itself, anyone on the LAN can answer SSDP.
+                    if self._on_host(location, addr):
+                        return location, addr
+                    log.debug('UPnP: ignoring LOCATION %s from %s',
+                              location, addr)
+
+    @staticmethod
+    def _on_host(url, addr):
+        from urllib.parse import urlparse
+        try:
+            o = urlparse(url)
+            o.port  # Raises ValueError for a malformed port
+        except ValueError:
+            return False
+        return o.scheme == 'http' and o.hostname == addr
+
+    @staticmethod
+    def _open(req, timeout):
+        # The gateway lives on the LAN: never go through http(s)_proxy and
+        # never follow a redirect away from it.
+        from urllib.request import (build_opener, HTTPRedirectHandler,
+                                    ProxyHandler)
+
+        class NoRedirect(HTTPRedirectHandler):
+            def redirect_request(self, *args, **kwargs):
+                return None
+
+        return build_opener(ProxyHandler({}), NoRedirect).open(
+            req, timeout=timeout)
+
+    def _external_ip(self, location, addr, timeout):
+        from urllib.parse import urljoin
+        from urllib.request import Request
+        with self._open(location, timeout) as rsp:
+            desc = rsp.read()
+        for m in self._SERVICE_RE.finditer(desc):
+            st = self._TYPE_RE.search(m.group(1))
+            ctl = self._CONTROL_RE.search(m.group(1))
+            if st and ctl and st.group(1).decode('ascii') in self.SERVICES:
+                break
+        else:
+            raise ValueError(f"no WAN connection service at {location}")
+        st = st.group(1).decode('ascii')
+        control = urljoin(location, ctl.group(1).decode('ascii'))
+        if not self._on_host(control, addr):
+            raise ValueError(f"control URL {control} is not on {addr}")
+        body = ('<?xml version="1.0"?>'
+                '<s:Envelope'
+                ' xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"'
+                ' s:encodingStyle='
+                '"http://schemas.xmlsoap.org/soap/encoding/">'
+                f'<s:Body><u:GetExternalIPAddress xmlns:u="{st}"/>'
+                '</s:Body></s:Envelope>').encode('ascii')
+        req = Request(control, data=body, headers={
+            'Content-Type': 'text/xml; charset="utf-8"',
+            'SOAPAction': f'"{st}#GetExternalIPAddress"' })
+        with self._open(req, timeout) as rsp:
+            m = self._IP_RE.search(rsp.read())
+        if m is None:
+            raise ValueError("no NewExternalIPAddress in reply")
+        return m.group(1).decode('ascii')
+
+    def get(self):
+        log.debug('UPnP: SSDP discovery')
+        deadline = time() + self.timeout
         try:
-            ip = cp.stdout.split('\n')[0].strip()
+            location, addr = self._discover(self.timeout)
+            log.debug('UPnP: %s', location)
+            ip = self._external_ip(location, addr,
+                                   max(deadline - time(), 0.1))
         except Exception as e:
-            return False, f"STUN stunip.py response {e} cmd={cmd}"
+            return False, f"UPnP exception {e}"
+        # Behind a second NAT (e.g. carrier-grade) the gateway only knows
+        # its own private WAN address, which is not the one we want.
+        from ipaddress import IPv4Address
+        try:
+            if not IPv4Address(ip).is_global:
+                return False, f"UPnP gateway address {ip} is not global"
+        except ValueError as e:
+            return False, f"UPnP {e}"
         return True, ip
 
 
+# Default resolvers with their names precomputed, registered directly by
+# NATAddress() without going through the add_*() name derivation.
+_WWW = (
+    ('www_akamai', 'http://whatismyip.akamai.com'),
+    ('www_amazonaws', 'http://checkip.amazonaws.com'),
+    ('www_curlmyip', 'http://curlmyip.net'),
+    ('www_icanhazip', 'http://icanhazip.com'),
+    ('www_ident', 'http://v4.ident.me'),
+    ('www_ifconfig', 'http://ifconfig.me'),
+    ('www_ipecho', 'http://ipecho.net/plain'),
+    ('www_ipify', 'https://api.ipify.org'),
+    ('www_ipinfo', 'http://ipinfo.io/ip'),
+    ('www_ipquail', 'http://4.ipquail.com/ip'),
+    ('www_myexternalip', 'http://myexternalip.com/raw'),
+    ('www_ipaddr-pub', 'https://ipaddr.pub/cli'),
+)
+
+# (name, servers, dns_name, dns_class, dns_type)
+_DNS = (
+    # https://bit.ly/2AHfQMb
+    # nameservers discovered via:
+    #  curl -s https://rdap.verisign.com/net/v1/domain/akamaitech.net |
+    #    jq -r .nameservers[].ldhName | tr '[A-Z]' '[a-z]' | grep ^ns
+    ('dns_akamai',
+     ('ns1-1.akamaitech.net', 'ns2-193.akamaitech.net',
+      'ns3-193.akamaitech.net', 'ns4-193.akamaitech.net',
+      'ns5-193.akamaitech.net'),
+     'whoami.akamai.net', '', ''),
+    # https://bit.ly/2AHfQMb
+    # nameserver discovered via:
+    #  curl -s https://rdap.verisign.com/net/v1/domain/akam.net |
+    #    jq -r .nameservers[].ldhName | tr '[A-Z]' '[a-z]'
+    ('dns_akahelp',
+     ('a1-67.akam.net', 'a11-67.akam.net', 'a12-67.akam.net',
+      'a13-67.akam.net', 'a18-67.akam.net', 'a22-67.akam.net',
+      'a28-67.akam.net', 'a3-67.akam.net', 'a4-67.akam.net',
+      'a5-67.akam.net', 'a6-67.akam.net', 'a7-67.akam.net',
+      'a9-67.akam.net'),
+     'whoami.ds.akahelp.net', '', 'txt'),
+    # https://bit.ly/3AUhNzS
+    ('dns_cloudflare', ('1.1.1.1', '1.0.0.1'),
+     'whoami.cloudflare', 'ch', 'txt'),
+    # https://gist.github.com/ipoddubny/27111c83c3a2870a55e1
+    ('dns_google',
+     ('ns1.google.com', 'ns2.google.com', 'ns3.google.com',
+      'ns4.google.com'),
+     'o-o.myaddr.l.google.com', '', 'txt'),
+)
+
+# STUN servers curated from:
+#  https://github.com/pradt2/always-online-stun/blob/master/valid_hosts.txt
+_STUN = (
+    ('stun_google-1', 'stun1.l.google.com:19302'),
+    ('stun_google-2', 'stun2.l.google.com:19302'),
+    ('stun_google-3', 'stun3.l.google.com:19302'),
+    ('stun_google-4', 'stun4.l.google.com:19302'),
+    ('stun_acronis', 'stun.acronis.com'),
+    ('stun_bethesda', 'stun.bethesda.net'),
+    ('stun_callwithus', 'stun.callwithus.com'),
+    ('stun_counterpath', 'stun.counterpath.net'),
+    ('stun_easyvoip', 'stun.easyvoip.com'),
+    ('stun_ekiga', 'stun.ekiga.net'),
+    ('stun_gmx', 'stun.gmx.net'),
+    ('stun_intervoip', 'stun.intervoip.com'),
+    ('stun_poivy', 'stun.poivy.com'),
+    ('stun_sipgate', 'stun.sipgate.net'),
+    ('stun_siptraffic', 'stun.siptraffic.com'),
+    ('stun_sonetel', 'stun.sonetel.com'),
+    ('stun_vivox', 'stun.vivox.com'),
+    ('stun_voipbuster', 'stun.voipbuster.com'),
+    ('stun_voipgate', 'stun.voipgate.com'),
+    ('stun_voipstunt', 'stun.voipstunt.com'),
+    ('stun_xten', 'stun.xten.com'),
+)
+
+
 class NATAddress:
-    def __init__(self, dig_bin='', stunip_bin='', timeout=5):
-        self.dig_bin = dig_bin
-        self.stunip_bin = stunip_bin
+    def __init__(self, timeout=5, defaults=True):
         self.timeout = timeout
         self._objs = {}
+        # Insertion ordered names, kept in step with _objs by _add(), so
+        # random picks need not copy the dict keys each time.
+        self._names = ()
+        self._rng = Random()
+        if not defaults:
+            return
+        objs = self._objs
+        for name, url in _WWW:
+            objs[name] = NATAddressWWW(url=url, timeout=timeout)
+        for name, servers, dns_name, dns_class, dns_type in _DNS:
+            objs[name] = NATAddressDNS(
+                servers=servers, dns_name=dns_name, dns_class=dns_class,
+                dns_type=dns_type, timeout=timeout)
+        for name, server in _STUN:
+            objs[name] = NATAddressSTUN(server=server, timeout=timeout)
+        objs['upnp_igd'] = NATAddressUPnP(timeout=timeout)
+        self._names = tuple(objs)
 
     def names(self, sort=True):
-        n = list(self._objs)
         if sort:
-            n = sorted(n)
-        return n
+            return sorted(self._names)
+        return self._names  # Immutable, no need to copy
 
     def get(self, name=''):
         if not self._objs:
             return False, f"no resolvers available"
         if not name:
-            name = choice(self.names(sort=False))
+            name = self._names[self._rng.randrange(len(self._names))]
         o = self._objs.get(name, None)
         if o is None:
             return False, f"invalid name '{name}'"
-        if VERBOSE > 0:
-            print(f"# name: {name}")
-        ok, msg = o.get()
+        log.info('name: %s', name)
+        return self._check(*o.get())
+
+    def get_race(self, n=5, names=None):
+        from queue import Queue, Empty
+        if n < 1:
+            return False, "race count must be positive"
+        if names is None:
+            names = self._names
+        if not names:
+            return False, "no resolvers available"
+        for name in names:
+            if name not in self._objs:
+                return False, f"invalid name '{name}'"
+        # A UPnP gateway answers from the LAN, faster than any remote
+        # resolver, so it always joins the race. It runs on top of the n
+        # remote resolvers rather than taking one of their places.
+        local = [ name for name in names
+                  if isinstance(self._objs[name], NATAddressUPnP) ]
+        others = [ name for name in names if name not in local ]
+        if local:
+            from urllib.request import getproxies
+            proxies = getproxies()
+            if proxies.get('http') or proxies.get('https'):
+                # The www resolvers then report the proxy's egress address,
+                # the gateway's WAN address would disagree with them.
+                local = []
+        picked = local + self._rng.sample(others, min(n, len(others)))
+        if not picked:
+            return False, "no resolvers available"
+        log.info('race: %s', ' '.join(picked))
+        results = Queue()
+
+        def probe(name):
+            try:
+                results.put((name, self._objs[name].get()))
+            except Exception as e:
+                results.put((name, (False, f"{e} name='{name}'")))
+
+        # Daemon threads, once a winner is found the slower lookups are
+        # left behind and cannot hold up interpreter exit.
+        for name in picked:
+            Thread(target=probe, args=(name,), daemon=True).start()
+        errors = []
+        deadline = time() + self.timeout + 1
+        for _ in picked:
+            try:
+                name, (ok, msg) = results.get(
+                    timeout=max(deadline - time(), 0))
+            except Empty:
+                errors.append(f"race timeout after {self.timeout + 1}s")
+                break
+            ok, msg = self._check(ok, msg)
+            if ok:
+                log.info('name: %s', name)
+                return True, msg
+            errors.append(msg)
+        return False, '; '.join(errors)
+
+    async def get_async(self, names=None):
+        import asyncio
+        if names is None:
+            names = self._names
+        for name in names:
+            if name not in self._objs:
+                return False, f"invalid name '{name}'"
+        objs = [ self._objs[name] for name in names
+                 if isinstance(self._objs[name], NATAddressWWW) ]
+        if not objs:
+            return False, "no www resolvers available"
+        # All requests share one event loop instead of a thread each
+        tasks = { asyncio.create_task(o.get_async()): o for o in objs }
+        errors = []
+        try:
+            while tasks:
+                done, _ = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    o = tasks.pop(t)
+                    ok, msg = self._check(*t.result())
+                    if ok:
+                        log.info('www async: %s', o.url)
+                        return True, msg
+                    errors.append(msg)
+        finally:
+            for t in tasks:
+                t.cancel()
+        return False, '; '.join(errors)
+
+    def stun_race(self, names=None):
+        from select import select
+        if names is None:
+            names = self._names
+        for name in names:
+            if name not in self._objs:
+                return False, f"invalid name '{name}'"
+        objs = { name: self._objs[name] for name in names
+                 if isinstance(self._objs[name], NATAddressSTUN) }
+        if not objs:
+            return False, "no stun resolvers available"
+        # Submit every binding request from one socket, then wait for the
+        # first reply instead of one round-trip per server. Hostnames are
+        # resolved (and their request sent) on daemon threads, so a slow
+        # or dead domain cannot hold up the others or the deadline.
+        deadline = time() + self.timeout
+        pending = {}  # transaction id -> name
+        errors = []
+        failed = []
+
+        def send(sock, name, server):
+            host, _, port = server.partition(':')
+            txid = urandom(12)
+            try:
+                addr = (self._rng.choice(_resolve_host(host)),
+                        int(port or 3478))
+                pending[txid] = name  # Before sending, replies are fast
+                sock.sendto(_stun_request(txid), addr)
+            except Exception as e:
+                pending.pop(txid, None)
+                failed.append(f"STUN exception {e} server='{server}'")
+
+        log.debug('STUN race: %s', ' '.join(objs))
+        answered = 0
+        with socket(AF_INET, SOCK_DGRAM) as sock:
+            for name, o in objs.items():
+                Thread(target=send, args=(sock, name, o.server),
+                       daemon=True).start()
+            while answered + len(failed) < len(objs):
+                remaining = deadline - time()
+                if remaining <= 0 or not select([sock], [], [], remaining)[0]:
+                    break
+                try:
+                    data = sock.recv(1500)
+                except OSError:
+                    continue
+                name = pending.pop(data[8:20], None)
+                if name is None:
+                    continue  # Stray or duplicate reply
+                answered += 1
+                try:
+                    ok, msg = self._check(True, _stun_parse(data, data[8:20]))
+                except ValueError as e:
+                    ok, msg = False, f"{e} server='{objs[name].server}'"
+                if ok:
+                    log.info('name: %s', name)
+                    return True, msg
+                errors.append(msg)
+        errors += failed
+        silent = len(objs) - answered - len(failed)
+        if silent > 0:
+            errors.append(f"STUN timeout, {silent} servers silent")
+        return False, '; '.join(errors)
+
+    def _check(self, ok, msg):
         if not ok:
             return False, msg
-        try:
-            ip = IPv4Address(msg)
-        except Exception as e:
-            return False, f"IPv4 Address exception {e} for ip='{msg}'"
-        return True, str(ip)
+        if _parse_ipv4(msg) is None:
+            return False, f"invalid IPv4 address ip='{msg}'"
+        return True, msg
 
     def add_www(self, url, name=''):
         if not name:
+            from urllib.parse import urlparse
             o = urlparse(url)
             # Obtain domain just below the tld, w/o the port num
             name = o.netloc.split(':')[0].split('.')[-2]
-        name = f"www_{name}"
-        if name in self._objs:
-                raise RuntimeError(f"duplicate name '{name}'")
-        self._objs[name] = NATAddressWWW(url=url, timeout=self.timeout)
+        self._add(f"www_{name}",
+                  NATAddressWWW(url=url, timeout=self.timeout))
 
     def add_dns(self, servers, dns_name, dns_class='', dns_type='', name=''):
-        if not self.dig_bin:
-            return
         if not name:
             name = dns_name.split('.')[-2]
-        name = f"dns_{name}"
-        if name in self._objs:
-            raise RuntimeError(f"duplicate name '{name}'")
-        self._objs[name] = NATAddressDNS(
-            dig_bin=self.dig_bin, servers=servers, dns_name=dns_name,
-            dns_class=dns_class, dns_type=dns_type, timeout=self.timeout)
+        self._add(f"dns_{name}", NATAddressDNS(
+            servers=servers, dns_name=dns_name,
+            dns_class=dns_class, dns_type=dns_type, timeout=self.timeout))
 
     def add_stun(self, server, name=''):
-        if not self.stunip_bin:
-            return
         if not name:
             # Obtain domain just below the tld, w/o the port num
             name = server.split(':')[0].split('.')[-2]
-        name = f"stun_{name}"
+        self._add(f"stun_{name}",
+                  NATAddressSTUN(server=server, timeout=self.timeout))
+
+    def add_upnp(self, name=''):
+        self._add(f"upnp_{name or 'igd'}",
+                  NATAddressUPnP(timeout=self.timeout))
+
+    def _add(self, name, obj):
         if name in self._objs:
             raise RuntimeError(f"duplicate name '{name}'")
-        self._objs[name] = NATAddressSTUN(
-            stunip_bin=self.stunip_bin, server=server,
-            timeout=self.timeout)
+        self._objs[name] = obj
+        self._names += (name,)
 
 
-def main(args_raw):
-    global VERBOSE
-    p = argparse.ArgumentParser(
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
-        description='IPv4 NAT address lookup tool')
-    p.add_argument(
-        '-l', '--list',
+def _cache_file():
+    base = environ.get('XDG_CACHE_HOME') or '~/.cache'
+    return join(expanduser(base), 'natip', 'last.json')
+
+
+def _cache_read(ttl):
+    from json import loads
+    try:
+        with open(_cache_file()) as fd:
+            entry = loads(fd.read())
+        if 0 <= time() - entry['ts'] < ttl:
+            if _parse_ipv4(entry['ip']) is not None:
+                return entry['ip']
+    except Exception:
+        pass  # Missing, stale or corrupt entries are simply re-probed
+    return ''
+
+
+def _cache_write(ip):
+    from json import dumps
+    f = _cache_file()
+    tmp = f"{f}.{getpid()}.tmp"
+    try:
+        makedirs(dirname(f), exist_ok=True)
+        with open(tmp, 'w') as fd:
+            fd.write(dumps({ 'ip': ip, 'ts': time() }))
+        replace(tmp, f)  # Atomic, concurrent readers never see partial data
+    except OSError:
+        try:
+            unlink(tmp)
+        except OSError:
+            pass
+
+
+# Command line options as argparse add_argument() calls. They are only
+# fed to argparse for --help and errors, a normal run is scanned by
+# _parse_args() without importing and building an ArgumentParser.
+_OPTIONS = (
+    (('-l', '--list'), dict(
         default=False, action='store_true',
-        help='only list lookup resolvers')
-    p.add_argument(
-        '-n', '--name',
+        help='only list lookup resolvers')),
+    (('-n', '--name'), dict(
         default='',
-        help='when set uses specific "name" lookup')
-    p.add_argument(
-        '-t', '--timeout',
+        help='when set uses specific "name" lookup')),
+    (('-t', '--timeout'), dict(
         default=5, type=int,
-        help='timeout (in seconds) to wait for a response')
-    p.add_argument(
-        '-d', '--disable',
+        help='timeout (in seconds) to wait for a response')),
+    (('-d', '--disable'), dict(
         default=[], action='append',
-        help='disable resolver "name" from being used')
-    p.add_argument(
-        '-v', '--verbose',
-        default=VERBOSE, action='count',
-        help='verbosity, repeat to increase')
-    p.add_argument(
-        '--dig-bin',
-        default='dig',
-        help='full path to "dig" binary, empty disables DNS')
-    p.add_argument(
-        '--stunip-bin',
-        default='stunip.py',
-        help='full path to "stunip.py" binary, empty disables STUN')
-    args = p.parse_args(args_raw)
-    VERBOSE = args.verbose
-
-    if args.dig_bin:
-        dig = which(args.dig_bin)
-        if dig is None:
-            args.dig_bin = ''
-        else:
-            args.dig_bin = str(Path(dig).resolve())
-    if args.stunip_bin:
-        stunip = which(args.stunip_bin)
-        if stunip is None:
-            args.stunip_bin = ''
+        help='disable resolver "name" from being used')),
+    (('-m', '--mode'), dict(
+        default='race', choices=('race', 'www', 'stun'),
+        help='"race" queries random resolvers concurrently, "www" races'
+             ' all www resolvers on a single event loop, "stun" races all'
+             ' stun resolvers from a single socket')),
+    (('-r', '--race'), dict(
+        default=5, type=int,
+        help='number of random resolvers queried concurrently')),
+    (('--cache-ttl',), dict(
+        default=300, type=int,
+        help='seconds a cached address is reused, 0 disables the cache')),
+    (('--no-cache',), dict(
+        default=False, action='store_true',
+        help='ignore and do not update the cached address')),
+    (('-v', '--verbose'), dict(
+        default=0, action='count',
+        help='verbosity, repeat to increase')),
+)
+
+
+def _parser():
+    import argparse
+    p = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='IPv4 NAT address lookup tool')
+    for flags, kwargs in _OPTIONS:
+        p.add_argument(*flags, **kwargs)
+    return p
+
+
+def _error(msg):
+    _parser().error(msg)  # Exits with usage, same as argparse would
+
+
+_NEG_NUM_RE = re_compile(r'^-\d+$|^-\d*\.\d+$')
+
+
+def _parse_args(args_raw):
+    args = SimpleNamespace()
+    opts = {}
+    for flags, kwargs in _OPTIONS:
+        dest = flags[-1].lstrip('-').replace('-', '_')
+        default = kwargs['default']
+        if kwargs.get('action') == 'append':
+            default = list(default)
+        setattr(args, dest, default)
+        for f in flags:
+            opts[f] = (flags, dest, kwargs)
+
+    def is_option(tok):
+        # Mirrors argparse: anything dash-prefixed is an option, not a
+        # value, unless it is '-', a negative number or contains a space.
+        if not tok.startswith('-') or tok == '-':
+            return False
+        if tok.partition('=')[0] in opts:
+            return True
+        return not (_NEG_NUM_RE.match(tok) or ' ' in tok)
+
+    raw = list(args_raw)
+    extras = []  # Unrecognized, reported together at the end
+    i = 0
+    while i < len(raw):
+        arg = raw[i]
+        i += 1
+        if arg == '--':
+            extras += raw[i - 1:]
+            break
+        val, eq = None, ''
+        if arg.startswith('--'):
+            arg, eq, v = arg.partition('=')
+            if eq:
+                val = v
+            if arg not in opts and arg != '--help' and len(arg) > 2:
+                # Unique prefixes are accepted, like argparse's allow_abbrev
+                match = [ o for o in (*opts, '--help')
+                          if o.startswith(arg) and o.startswith('--') ]
+                if len(match) > 1:
+                    _error(f"ambiguous option: {raw[i - 1]} could match"
+                           f" {', '.join(match)}")
+                if match:
+                    arg = match[0]
+        elif arg.startswith('-') and len(arg) > 2:
+            arg, val = arg[:2], arg[2:]
+            if val.startswith('='):
+                val, eq = val[1:], '='  # -n=x is -n x, as in argparse
+        if arg in ('-h', '--help'):
+            _parser().print_help()
+            exit(0)
+        if arg not in opts:
+            extras.append(raw[i - 1])
+            continue
+        flags, dest, kwargs = opts[arg]
+        action = kwargs.get('action', 'store')
+        name = '/'.join(flags)
+
+        if action in ('store_true', 'count'):
+            if val is not None:
+                if arg.startswith('--') or eq:
+                    _error(f"argument {name}: ignored explicit argument"
+                           f" '{val}'")
+                raw.insert(i, f"-{val}")  # Bundled short flags, e.g. -vv
+            if action == 'count':
+                setattr(args, dest, getattr(args, dest) + 1)
+            else:
+                setattr(args, dest, True)
+            continue
+
+        if val is None:
+            if i == len(raw) or is_option(raw[i]):
+                _error(f"argument {name}: expected one argument")
+            val = raw[i]
+            i += 1
+        if 'type' in kwargs:
+            try:
+                val = kwargs['type'](val)
+            except ValueError:
+                _error(f"argument {name}: invalid"
+                       f" {kwargs['type'].__name__} value: '{val}'")
+        if 'choices' in kwargs and val not in kwargs['choices']:
+            choices = ', '.join(f"'{c}'" for c in kwargs['choices'])
+            _error(f"argument {name}: invalid choice: '{val}'"
+                   f" (choose from {choices})")
+        if action == 'append':
+            getattr(args, dest).append(val)
         else:
-            args.stunip_bin = str(Path(stunip).resolve())
-
-    na = NATAddress(dig_bin=args.dig_bin, stunip_bin=args.stunip_bin,
-                    timeout=args.timeout)
-
-    na.add_www('http://whatismyip.akamai.com')
-    na.add_www('http://checkip.amazonaws.com')
-    na.add_www('http://curlmyip.net')
-    na.add_www('http://icanhazip.com')
-    na.add_www('http://v4.ident.me')
-    na.add_www('http://ifconfig.me')
-    na.add_www('http://ipecho.net/plain')
-    na.add_www('https://api.ipify.org')
-    na.add_www('http://ipinfo.io/ip')
-    na.add_www('http://4.ipquail.com/ip')
-    na.add_www('http://myexternalip.com/raw')
-    na.add_www('https://ipaddr.pub/cli', name='ipaddr-pub')
+            setattr(args, dest, val)
+    if extras:
+        _error(f"unrecognized arguments: {' '.join(extras)}")
+    return args
 
-    # https://bit.ly/2AHfQMb
-    # nameservers discovered via:
-    #  curl -s https://rdap.verisign.com/net/v1/domain/akamaitech.net |
-    #    jq -r .nameservers[].ldhName | tr '[A-Z]' '[a-z]' | grep ^ns
-    na.add_dns(servers=['ns1-1.akamaitech.net', 'ns2-193.akamaitech.net',
-                        'ns3-193.akamaitech.net', 'ns4-193.akamaitech.net',
-                        'ns5-193.akamaitech.net'],
-               dns_name='whoami.akamai.net')
-    # https://bit.ly/2AHfQMb
-    # nameserver discovered via:
-    #  curl -s https://rdap.verisign.com/net/v1/domain/akam.net |
-    #    jq -r .nameservers[].ldhName | tr '[A-Z]' '[a-z]'
-    na.add_dns(servers=['a1-67.akam.net', 'a11-67.akam.net',
-                        'a12-67.akam.net', 'a13-67.akam.net',
-                        'a18-67.akam.net', 'a22-67.akam.net',
-                        'a28-67.akam.net', 'a3-67.akam.net',
-                        'a4-67.akam.net', 'a5-67.akam.net',
-                        'a6-67.akam.net', 'a7-67.akam.net',
-                        'a9-67.akam.net'],
-               dns_name='whoami.ds.akahelp.net', dns_type='txt')
-    # https://bit.ly/3AUhNzS
-    na.add_dns(servers=['1.1.1.1', '1.0.0.1'], dns_class='ch',
-               dns_name='whoami.cloudflare', dns_type='txt',
-               name='cloudflare')
-    # https://gist.github.com/ipoddubny/27111c83c3a2870a55e1
-    na.add_dns(servers=['ns1.google.com', 'ns2.google.com',
-                        'ns3.google.com', 'ns4.google.com' ],
-               dns_name='o-o.myaddr.l.google.com', dns_type='txt')
-
-    # STUN servers curated from:
-    #  https://github.com/pradt2/always-online-stun/blob/master/valid_hosts.txt
-    na.add_stun('stun1.l.google.com:19302', name='google-1')
-    na.add_stun('stun2.l.google.com:19302', name='google-2')
-    na.add_stun('stun3.l.google.com:19302', name='google-3')
-    na.add_stun('stun4.l.google.com:19302', name='google-4')
-    na.add_stun('stun.acronis.com')
-    na.add_stun('stun.bethesda.net')
-    na.add_stun('stun.callwithus.com')
-    na.add_stun('stun.counterpath.net')
-    na.add_stun('stun.easyvoip.com')
-    na.add_stun('stun.ekiga.net')
-    na.add_stun('stun.gmx.net')
-    na.add_stun('stun.intervoip.com')
-    na.add_stun('stun.poivy.com')
-    na.add_stun('stun.sipgate.net')
-    na.add_stun('stun.siptraffic.com')
-    na.add_stun('stun.sonetel.com')
-    na.add_stun('stun.vivox.com')
-    na.add_stun('stun.voipbuster.com')
-    na.add_stun('stun.voipgate.com')
-    na.add_stun('stun.voipstunt.com')
-    na.add_stun('stun.xten.com')
+
+def main(args_raw):
+    global _LOG_HANDLER
+    args = _parse_args(args_raw)
+    if args.verbose:
+        from logging import getLogger, Formatter, StreamHandler, DEBUG, INFO
+        logger = getLogger('natip')
+        if _LOG_HANDLER is None:  # main() may run more than once
+            _LOG_HANDLER = StreamHandler()
+            _LOG_HANDLER.setFormatter(Formatter('# %(message)s'))
+            logger.addHandler(_LOG_HANDLER)
+            logger.propagate = False  # Root handlers would repeat it
+        logger.setLevel(DEBUG if args.verbose > 1 else INFO)
+
+    # Anything narrowing which resolvers are asked wants a fresh answer
+    use_cache = (args.cache_ttl > 0 and not args.no_cache and
+                 not args.name and not args.list and not args.disable and
+                 args.mode == 'race')
+    if use_cache:
+        ip = _cache_read(args.cache_ttl)
+        if ip:
+            log.info('cache: %s', _cache_file())
+            print(ip)
+            return
+
+    na = NATAddress(timeout=args.timeout)
 
     if args.list:
         print('\n'.join(na.names()))
         return
 
+    if args.race < 1:
+        _error(f"race count must be positive, got {args.race}")
+
+    names = None
     if args.disable:
         if args.name and args.name in args.disable:
-            p.error(f"name '{args.name}' disabled by user")
-        tmp = set(na.names(sort=False)) - set(args.disable)
-        if not tmp:
-            p.error("all resolvers disabled")
-        args.name = choice(list(tmp))
+            _error(f"name '{args.name}' disabled by user")
+        disabled = set(args.disable)
+        names = tuple(n for n in na.names(sort=False) if n not in disabled)
+        if not names:
+            _error("all resolvers disabled")
 
-    ok, msg = na.get(name=args.name)
+    if args.name:
+        ok, msg = na.get(name=args.name)
+    elif args.mode == 'www':
+        import asyncio
+        ok, msg = asyncio.run(na.get_async(names=names))
+    elif args.mode == 'stun':
+        ok, msg = na.stun_race(names=names)
+    else:
+        ok, msg = na.get_race(n=args.race, names=names)
     if not ok:
-        p.error(msg)
+        _error(msg)
+    if use_cache:
+        _cache_write(msg)
     print(msg)
 
 
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import unittest
+
+from contextlib import redirect_stderr, redirect_stdout
+from io import StringIO
+
+import natip
+
+
+def _run(parse, args):
+    err = StringIO()
+    try:
+        with redirect_stderr(err), redirect_stdout(StringIO()):
+            return vars(parse(args))
+    except SystemExit as e:
+        return ('exit', e.code, err.getvalue().strip().splitlines()[-1:])
+
+
+class ParseArgsTest(unittest.TestCase):
+    # _parse_args() must accept, reject and report exactly what the
+    # argparse parser built from the same _OPTIONS table would.
+    CASES = (
+        [], ['-l'], ['-vv', '-n', 'www_x'], ['-vl'], ['-vn', 'x'],
+        ['-t3', '-d', 'a', '-d', 'b'], ['--timeout=7'], ['--name=foo'],
+        ['--mode', 'www'], ['-m', 'bad'], ['-t', 'x'], ['-t', '-5'],
+        ['-n'], ['--list=1'], ['-l=1'], ['--bogus'], ['pos'],
+        ['pos', 'x', '-l'], ['--bogus', '-l', 'y'], ['-l', '--', '-v'],
+        ['--', 'x'], ['--cache-ttl', '0', '--no-cache'],
+        ['-r', '2', '-v', '-v', '-v'], ['--verbose=2'],
+        # Unique long-option prefixes
+        ['--time', '3', '-l'], ['--verb', '-l'], ['--no', '-l'],
+        ['--cache', '5'], ['--n', 'x'], ['--na', 'x'], ['--time=4'],
+        ['--lis=1'], ['--d', 'a', '--d', 'b'], ['--mo', 'www'],
+        ['--no-c'], ['--r', '2'],
+        # Options are never taken as another option's value
+        ['-n', '--list'], ['-n', '-d'], ['-d', '-l'], ['-n', '--'],
+        ['--name', '-x'], ['-n', '--tim'], ['-n', '-'], ['-n', ''],
+        ['-n', '-x y'], ['-d', '--list=1'],
+        # Short options with an attached '=value'
+        ['-d=x'], ['-n=x'], ['-t=3'], ['-m=www'], ['-v=1'],
+    )
+
+    def test_matches_argparse(self):
+        for args in self.CASES:
+            with self.subTest(args=args):
+                self.assertEqual(_run(natip._parse_args, args),
+                                 _run(natip._parser().parse_args, args))
+
+
+if __name__ == '__main__':
+    unittest.main()